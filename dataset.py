@@ -1,12 +1,17 @@
+import collections
 import json
 import logging
 import os
+import shutil
+import tempfile
 from functools import partial
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count, get_context
+from multiprocessing.shared_memory import SharedMemory
 
 import numpy as np
 from tqdm import tqdm
 
+from transformers import PreTrainedTokenizerFast
 from transformers.file_utils import is_tf_available, is_torch_available
 
 if is_torch_available():
@@ -16,8 +21,16 @@ if is_torch_available():
 if is_tf_available():
     import tensorflow as tf
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# Version of the pickled AlibabaFeatures layout, bump it whenever the layout changes so cached features are rebuilt.
+FEATURES_FORMAT_VERSION = 3
+
 
 def _improve_answer_span(doc_tokens, answer_tokens, input_start, input_end):
     """Returns tokenized answer spans that better match the annotated answer."""
@@ -29,10 +42,22 @@ def _improve_answer_span(doc_tokens, answer_tokens, input_start, input_end):
     #         if text_span == tok_answer_text:
     #             return (new_start, new_end)
 
-    for new_start in range(0, len(doc_tokens)):
-        for new_end in range(len(doc_tokens)-1, new_start - 1, -1):
-            if ''.join(doc_tokens[new_start:(new_end + 1)]) == ''.join(answer_tokens):
-                return (new_start, new_end)
+    joined = ''.join(doc_tokens)
+    needle = ''.join(answer_tokens)
+    if not needle:
+        return (input_start, input_end)
+
+    # offsets[i] is the (exclusive) end character offset of doc_tokens[i] in joined
+    offsets = np.fromiter((len(t) for t in doc_tokens), dtype=np.int64, count=len(doc_tokens)).cumsum()
+    pos = joined.find(needle)
+    while pos != -1:
+        new_start = int(np.searchsorted(offsets, pos, side='right'))
+        new_end = int(np.searchsorted(offsets, pos + len(needle) - 1, side='right'))
+        # only accept matches that begin and end on token boundaries
+        token_begin = offsets[new_start - 1] if new_start > 0 else 0
+        if token_begin == pos and offsets[new_end] == pos + len(needle):
+            return (new_start, new_end)
+        pos = joined.find(needle, pos + 1)
 
     return (input_start, input_end)
 
@@ -57,52 +82,44 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
     return cur_span_index == best_span_index
 
 
-def _new_check_is_max_context(doc_spans, cur_span_index, position):
-    """Check if this is the 'max context' doc span for the token."""
-    # if len(doc_spans) == 1:
-    # return True
-    best_score = None
-    best_span_index = None
-    for (span_index, doc_span) in enumerate(doc_spans):
-        end = doc_span["start"] + doc_span["length"] - 1
-        if position < doc_span["start"]:
-            continue
-        if position > end:
-            continue
-        num_left_context = position - doc_span["start"]
-        num_right_context = end - position
-        score = min(num_left_context, num_right_context) + 0.01 * doc_span["length"]
-        if best_score is None or score > best_score:
-            best_score = score
-            best_span_index = span_index
+def _max_context_span_indices(spans):
+    """For every paragraph token position, returns the index of the span in which the token has its 'max context'."""
+    if not spans:
+        return np.empty(0, dtype=np.int64)
+    starts = np.array([span["start"] for span in spans])
+    lengths = np.array([span["length"] for span in spans])
+    ends = starts + lengths - 1
+    positions = np.arange(ends.max() + 1)
+    # (num_spans, num_positions)
+    num_left_context = positions[None, :] - starts[:, None]
+    num_right_context = ends[:, None] - positions[None, :]
+    score = np.minimum(num_left_context, num_right_context) + 0.01 * lengths[:, None]
+    score[(num_left_context < 0) | (num_right_context < 0)] = -np.inf
+    return score.argmax(axis=0)
 
-    return cur_span_index == best_span_index
 
+_WHITESPACE_CHARS = frozenset(" \t\r\n\u202f")
 
-def _is_whitespace(c):
-    if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
-        return True
-    return False
 
+def _is_whitespace(c):
+    return c in _WHITESPACE_CHARS
 
-def convert_example_to_features(example, max_seq_length, doc_stride, max_query_length, is_training):
-    features = []
 
-    doc_tokens = tokenizer.tokenize(example.context_text)
+_TokenizerConstants = collections.namedtuple(
+    "_TokenizerConstants",
+    [
+        "sequence_added_tokens",
+        "sequence_pair_added_tokens",
+        "pad_token_id",
+        "cls_token_id",
+        "padding_side",
+        "special_token_ids",
+    ],
+)
 
-    # get start and end positions in paragraph token sequence
-    if is_training and not example.is_impossible:
-        answer_tokens = tokenizer.tokenize(example.answer_text)
-        start_position = example.start_position  # original start position before tokenizing
-        end_position = example.end_position  # original end position before tokenizing
-        tok_start_position, tok_end_position = _improve_answer_span(doc_tokens, answer_tokens, start_position, end_position)
 
-    spans = []
-    # if len(example.context_text) > max_seq_length - len(example.question_text):
-    #     print(example.qas_id)
-    truncated_query = tokenizer.encode(
-        example.question_text, add_special_tokens=False, truncation=True, max_length=max_query_length
-    )
+def _get_tokenizer_constants(tokenizer):
+    """Computes the tokenizer constants used to convert examples, once per process instead of once per example."""
     # =2
     sequence_added_tokens = (
         tokenizer.max_len - tokenizer.max_len_single_sentence + 1
@@ -111,126 +128,499 @@ def convert_example_to_features(example, max_seq_length, doc_stride, max_query_l
     )
     # =3
     sequence_pair_added_tokens = tokenizer.max_len - tokenizer.max_len_sentences_pair
+    # get_special_tokens_mask only tests membership, so the ids it flags can be computed once
+    all_special_ids = tokenizer.all_special_ids
+    special_tokens_mask = tokenizer.get_special_tokens_mask(all_special_ids, already_has_special_tokens=True)
+    special_token_ids = np.array(
+        sorted(token_id for token_id, is_special in zip(all_special_ids, special_tokens_mask) if is_special),
+        dtype=np.int32,
+    )
+    return _TokenizerConstants(
+        sequence_added_tokens=sequence_added_tokens,
+        sequence_pair_added_tokens=sequence_pair_added_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        cls_token_id=tokenizer.cls_token_id,
+        padding_side=tokenizer.padding_side,
+        special_token_ids=special_token_ids,
+    )
 
-    span_doc_tokens = doc_tokens
-    while len(spans) * doc_stride < len(doc_tokens):
-        encoded_dict = tokenizer.encode_plus(
-            truncated_query,
-            span_doc_tokens,
-            truncation='only_second',
-            padding="max_length",
-            max_length=max_seq_length,
-            return_overflowing_tokens=True,
-            stride=max_seq_length - doc_stride - len(truncated_query) - sequence_pair_added_tokens,
-            return_token_type_ids=True,
-            return_attention_mask=True
-        )
-        # len of paragraph tokens sequence of this span
-        paragraph_len = min(
-            len(doc_tokens) - len(spans) * doc_stride,  # 当最后一个span
-            max_seq_length - len(truncated_query) - sequence_pair_added_tokens,
+
+def _specialize_spans_to_features(constants):
+    """
+    Returns the function building the :class:`AlibabaFeatures` of one example from its encoded doc spans, with the
+    tokenizer constants captured as closure variables.
+    """
+    pad_token_id = constants.pad_token_id
+    cls_token_id = constants.cls_token_id
+    left_padding = constants.padding_side == "left"
+    special_token_ids = constants.special_token_ids
+
+    def spans_to_features(example, spans, tok_start_position, tok_end_position, is_training):
+        features = []
+        best_span_indices = _max_context_span_indices(spans)
+        for doc_span_index, span in enumerate(spans):
+            is_max_context = best_span_indices[span["start"]: span["start"] + span["paragraph_len"]] == doc_span_index
+            index_offset = 0 if left_padding else span["truncated_query_with_special_tokens_length"]
+            span["token_is_max_context"] = np.zeros(len(span["input_ids"]), dtype=np.uint8)
+            span["token_is_max_context"][index_offset: index_offset + span["paragraph_len"]] = is_max_context
+        for span in spans:
+            input_ids = np.asarray(span["input_ids"], dtype=np.int32)
+            # Identify the position of the CLS token (normally =0)
+            cls_index = int(np.argmax(input_ids == cls_token_id))
+
+            # p_mask: mask with 1 for token than cannot be in the answer (0 for token which can be in an answer)
+            doc_offset = span["truncated_query_with_special_tokens_length"]
+            p_mask = np.ones(len(input_ids), dtype=np.uint8)
+            p_mask[doc_offset: doc_offset + span["paragraph_len"]] = 0
+            p_mask |= input_ids == pad_token_id
+            p_mask |= np.isin(input_ids, special_token_ids)
+
+            # Set the cls index to 0: the CLS index can be used for impossible answers
+            p_mask[cls_index] = 0
+
+            span_is_impossible = example.is_impossible
+            start_position = 0
+            end_position = 0
+
+            if is_training and not span_is_impossible:
+                # For training, if our document chunk does not contain an annotation
+                # we throw it out, since there is nothing to predict.
+                doc_start = span['start']
+                doc_end = span['start'] + span['length'] - 1
+                out_of_span = False
+
+                if not (tok_start_position >= doc_start and tok_end_position <= doc_end):
+                    out_of_span = True
+
+                if out_of_span:
+                    start_position = cls_index
+                    end_position = cls_index
+                    span_is_impossible = True
+                else:
+                    start_position = tok_start_position - doc_start + doc_offset
+                    end_position = tok_end_position - doc_start + doc_offset
+
+            features.append(AlibabaFeatures(
+                span['input_ids'],
+                span['attention_mask'],
+                span['token_type_ids'],
+                cls_index,
+                p_mask,
+                example_index=0,
+                # Can not set unique_id and example_index here. They will be set after multiple processing.
+                unique_id=0,
+                paragraph_len=span['paragraph_len'],
+                token_is_max_context=span['token_is_max_context'],
+                tokens=span['tokens'],
+                token_to_orig_map=span["token_to_orig_map"],
+                start_position=start_position,
+                end_position=end_position,
+                is_impossible=span_is_impossible,
+                qas_id=example.qas_id
+            ))
+        return features
+
+    return spans_to_features
+
+
+def _specialize_convert_example_to_features(tokenizer, constants):
+    """
+    Returns :func:`convert_example_to_features` for one tokenizer, with its bound methods and constants captured
+    as closure variables instead of being looked up again for every example and span.
+    """
+    tokenize = tokenizer.tokenize
+    encode = tokenizer.encode
+    encode_plus = tokenizer.encode_plus
+    convert_ids_to_tokens = tokenizer.convert_ids_to_tokens
+    sequence_added_tokens = constants.sequence_added_tokens
+    sequence_pair_added_tokens = constants.sequence_pair_added_tokens
+    pad_token_id = constants.pad_token_id
+    spans_to_features = _specialize_spans_to_features(constants)
+
+    def convert_example_to_features(
+            example, max_seq_length, doc_stride, max_query_length, is_training, include_tokens=True
+    ):
+        doc_tokens = tokenize(example.context_text)
+
+        # get start and end positions in paragraph token sequence
+        tok_start_position = tok_end_position = None
+        if is_training and not example.is_impossible:
+            answer_tokens = tokenize(example.answer_text)
+            start_position = example.start_position  # original start position before tokenizing
+            end_position = example.end_position  # original end position before tokenizing
+            tok_start_position, tok_end_position = _improve_answer_span(
+                doc_tokens, answer_tokens, start_position, end_position
+            )
+
+        spans = []
+        # if len(example.context_text) > max_seq_length - len(example.question_text):
+        #     print(example.qas_id)
+        truncated_query = encode(
+            example.question_text, add_special_tokens=False, truncation=True, max_length=max_query_length
         )
-        if tokenizer.pad_token_id in encoded_dict['input_ids']:
-            non_padded_ids = encoded_dict["input_ids"][: encoded_dict["input_ids"].index(tokenizer.pad_token_id)]
-        else:
-            non_padded_ids = encoded_dict['input_ids']
-
-        tokens = tokenizer.convert_ids_to_tokens(non_padded_ids)
-
-        token_to_orig_map = {}
-        for i in range(paragraph_len):
-            index = len(truncated_query)+sequence_added_tokens+i
-            token_to_orig_map[index] = len(spans) * doc_stride + i
-
-        encoded_dict['paragraph_len'] = paragraph_len
-        encoded_dict['tokens'] = tokens
-        encoded_dict["token_to_orig_map"] = token_to_orig_map
-        encoded_dict["truncated_query_with_special_tokens_length"] = len(truncated_query) + sequence_added_tokens
-        encoded_dict['token_is_max_context'] = {}
-        encoded_dict['start'] = len(spans) * doc_stride
-        encoded_dict['length'] = paragraph_len
-
-        spans.append(encoded_dict)
-
-        if 'overflowing_tokens' not in encoded_dict or (
-                'overflowing_tokens' in encoded_dict and len(encoded_dict['overflowing_tokens']) == 0):
-            break
-        span_doc_tokens = encoded_dict['overflowing_tokens']
-
-    for doc_span_index in range(len(spans)):
-        for j in range(spans[doc_span_index]['paragraph_len']):
-            is_max_context = _new_check_is_max_context(spans, doc_span_index, doc_span_index * doc_stride + j)
-            index = (
-                j
-                if tokenizer.padding_side == "left"
-                else spans[doc_span_index]["truncated_query_with_special_tokens_length"] + j
+        span_doc_tokens = doc_tokens
+        while len(spans) * doc_stride < len(doc_tokens):
+            encoded_dict = encode_plus(
+                truncated_query,
+                span_doc_tokens,
+                truncation='only_second',
+                padding="max_length",
+                max_length=max_seq_length,
+                return_overflowing_tokens=True,
+                stride=max_seq_length - doc_stride - len(truncated_query) - sequence_pair_added_tokens,
+                return_token_type_ids=True,
+                return_attention_mask=True
             )
-            spans[doc_span_index]["token_is_max_context"][index] = is_max_context
-    for span in spans:
-        # Identify the position of the CLS token (normally =0)
-        cls_index = span["input_ids"].index(tokenizer.cls_token_id)
-
-        # p_mask: mask with 1 for token than cannot be in the answer (0 for token which can be in an answer)
-        p_mask = np.ones_like(span["token_type_ids"])
-        p_mask[len(truncated_query) + sequence_added_tokens:] = 0
-        pad_token_indices = np.where(np.array(span["input_ids"]) == tokenizer.pad_token_id)
-        special_token_indices = np.asarray(
-            tokenizer.get_special_tokens_mask(span["input_ids"], already_has_special_tokens=True)
-        ).nonzero()
-
-        p_mask[pad_token_indices] = 1
-        p_mask[special_token_indices] = 1
-
-        # Set the cls index to 0: the CLS index can be used for impossible answers
-        p_mask[cls_index] = 0
-
-        span_is_impossible = example.is_impossible
-        start_position = 0
-        end_position = 0
-
-        if is_training and not span_is_impossible:
-            # For training, if our document chunk does not contain an annotation
-            # we throw it out, since there is nothing to predict.
-            doc_start = span['start']
-            doc_end = span['start'] + span['length'] - 1
-            out_of_span = False
-
-            if not (tok_start_position >= doc_start and tok_end_position <= doc_end):
-                out_of_span = True
-
-            if out_of_span:
-                start_position = cls_index
-                end_position = cls_index
-                span_is_impossible = True
+            # len of paragraph tokens sequence of this span
+            paragraph_len = min(
+                len(doc_tokens) - len(spans) * doc_stride,  # 当最后一个span
+                max_seq_length - len(truncated_query) - sequence_pair_added_tokens,
+            )
+            tokens = None
+            if include_tokens:
+                is_pad = np.asarray(encoded_dict["input_ids"], dtype=np.int32) == pad_token_id
+                first_pad_index = int(np.argmax(is_pad)) if is_pad.any() else len(is_pad)
+                tokens = convert_ids_to_tokens(encoded_dict["input_ids"][:first_pad_index])
+
+            # (index of the first paragraph token, doc token index of every paragraph token)
+            token_to_orig_map = (
+                len(truncated_query) + sequence_added_tokens,
+                np.arange(len(spans) * doc_stride, len(spans) * doc_stride + paragraph_len, dtype=np.int32),
+            )
+
+            encoded_dict['paragraph_len'] = paragraph_len
+            encoded_dict['tokens'] = tokens
+            encoded_dict["token_to_orig_map"] = token_to_orig_map
+            encoded_dict["truncated_query_with_special_tokens_length"] = len(truncated_query) + sequence_added_tokens
+            encoded_dict['start'] = len(spans) * doc_stride
+            encoded_dict['length'] = paragraph_len
+
+            spans.append(encoded_dict)
+
+            if 'overflowing_tokens' not in encoded_dict or (
+                    'overflowing_tokens' in encoded_dict and len(encoded_dict['overflowing_tokens']) == 0):
+                break
+            span_doc_tokens = encoded_dict['overflowing_tokens']
+
+        return spans_to_features(example, spans, tok_start_position, tok_end_position, is_training)
+
+    return convert_example_to_features
+
+
+def convert_example_to_features(
+        example, max_seq_length, doc_stride, max_query_length, is_training, include_tokens=True
+):
+    """Placeholder, :func:`convert_example_to_features_init` replaces it with a version specialized for a tokenizer."""
+    raise RuntimeError("convert_example_to_features_init must be called before convert_example_to_features")
+
+
+def _new_feature_array(shape, dtype, memmap_dir=None):
+    """Allocates an array for the dataset, backed by an unlinked temporary file in memmap_dir if it is given."""
+    if memmap_dir is None or not shape[0]:
+        return np.empty(shape, dtype=dtype)
+    with tempfile.TemporaryFile(dir=memmap_dir) as f:
+        return np.memmap(f, mode="w+", dtype=dtype, shape=shape)
+
+
+# numeric feature fields, stored in one 2-D array per field in the smallest dtypes holding their values. The Pool
+# workers send them to the parent through shared memory instead of pickles.
+_FEATURE_ARRAY_FIELDS = (
+    ("input_ids", np.int32),
+    ("attention_mask", np.uint8),
+    ("token_type_ids", np.uint8),
+    ("p_mask", np.uint8),
+)
+
+
+def _shared_feature_arrays(buf, num_rows, max_seq_length):
+    """Views a shared buffer as one (num_rows, max_seq_length) array per field of _FEATURE_ARRAY_FIELDS."""
+    arrays = {}
+    offset = 0
+    for name, dtype in _FEATURE_ARRAY_FIELDS:
+        arrays[name] = np.ndarray((num_rows, max_seq_length), dtype=dtype, buffer=buf, offset=offset)
+        offset += arrays[name].nbytes
+    return arrays
+
+
+def _copy_shared_feature_rows(shared_memory, num_rows, max_seq_length, rows, fields, positions):
+    """Copies the given rows of every shared field to positions of fields, so that the shared memory can be released."""
+    arrays = _shared_feature_arrays(shared_memory.buf, num_rows, max_seq_length)
+    for name, _ in _FEATURE_ARRAY_FIELDS:
+        fields[name][positions] = arrays[name][rows]
+
+
+def _stack_feature_fields(features, max_seq_length):
+    """
+    Stacks the array fields of the features into one (len(features), max_seq_length) array per field, and makes
+    every feature view its row. The rows of fields a feature holds as None are left for the caller to fill.
+    """
+    fields = {}
+    for name, dtype in _FEATURE_ARRAY_FIELDS:
+        fields[name] = np.empty((len(features), max_seq_length), dtype=dtype)
+        for feature, row in zip(features, fields[name]):
+            value = getattr(feature, name)
+            if value is not None:
+                row[:] = value
+            setattr(feature, name, row)
+    return fields
+
+
+def _convert_indexed_example_to_features(
+        indexed_example, max_seq_length, doc_stride, max_query_length, is_training, include_tokens
+):
+    example_index, (first_row, num_rows), example = indexed_example
+    features = convert_example_to_features(
+        example, max_seq_length, doc_stride, max_query_length, is_training, include_tokens
+    )
+    # Move the numeric fields to the rows reserved for this example, features beyond them are pickled with them.
+    for index, feature in enumerate(features):
+        for name, dtype in _FEATURE_ARRAY_FIELDS:
+            if index < num_rows:
+                shared_feature_arrays[name][first_row + index] = getattr(feature, name)
+                setattr(feature, name, None)
             else:
-                doc_offset = len(truncated_query) + sequence_added_tokens
-                start_position = tok_start_position - doc_start + doc_offset
-                end_position = tok_end_position - doc_start + doc_offset
-
-        features.append(AlibabaFeatures(
-            span['input_ids'],
-            span['attention_mask'],
-            span['token_type_ids'],
-            cls_index,
-            p_mask.tolist(),
-            example_index=0,
-            # Can not set unique_id and example_index here. They will be set after multiple processing.
-            unique_id=0,
-            paragraph_len=span['paragraph_len'],
-            token_is_max_context=span['token_is_max_context'],
-            tokens=span['tokens'],
-            token_to_orig_map=span["token_to_orig_map"],
-            start_position=start_position,
-            end_position=end_position,
-            is_impossible=span_is_impossible,
-            qas_id=example.qas_id
-        ))
-    return features
+                setattr(feature, name, np.asarray(getattr(feature, name), dtype=dtype))
+    return example_index, features
+
+
+def _convert_example_to_features_pool_init(tokenizer_for_convert, shared_memory_name, num_rows, max_seq_length):
+    global shared_memory, shared_feature_arrays
+    convert_example_to_features_init(tokenizer_for_convert)
+    shared_memory = SharedMemory(name=shared_memory_name)
+    shared_feature_arrays = _shared_feature_arrays(shared_memory.buf, num_rows, max_seq_length)
 
 
 def convert_example_to_features_init(tokenizer_for_convert):
-    global tokenizer
-    tokenizer = tokenizer_for_convert
+    global convert_example_to_features
+    convert_example_to_features = _specialize_convert_example_to_features(
+        tokenizer_for_convert, _get_tokenizer_constants(tokenizer_for_convert)
+    )
+
+
+def _first_context_index(encoded, span_index):
+    """Returns the index of the first context token of an encoded question/context pair, None if it has none."""
+    if hasattr(encoded, "sequence_ids"):
+        sequence_ids = encoded.sequence_ids(span_index)
+    else:
+        # older BatchEncodings only tell the sequences apart by their token type ids
+        sequence_ids = encoded["token_type_ids"][span_index]
+    return sequence_ids.index(1) if 1 in sequence_ids else None
+
+
+# number of examples encoded per call of the fast tokenizer
+_FAST_TOKENIZER_BATCH_SIZE = 1000
+
+
+def _convert_examples_to_features_fast(
+        examples,
+        tokenizer,
+        max_seq_length,
+        doc_stride,
+        max_query_length,
+        is_training,
+        include_tokens,
+        tqdm_enabled=True,
+):
+    """Batch version of :func:`convert_example_to_features` for tokenizers backed by the Rust `tokenizers` library."""
+    constants = _get_tokenizer_constants(tokenizer)
+    spans_to_features = _specialize_spans_to_features(constants)
+    # Truncate the questions to max_query_length tokens by cutting the text after the last kept token.
+    encoded_questions = tokenizer(
+        [example.question_text for example in examples],
+        add_special_tokens=False,
+        truncation=True,
+        max_length=max_query_length,
+        return_offsets_mapping=True,
+    )
+    questions = [
+        example.question_text[: offsets[-1][1]] if offsets else example.question_text
+        for example, offsets in zip(examples, encoded_questions["offset_mapping"])
+    ]
+    # Tokenizers like byte-level BPE do not always split the cut text into the tokens it was cut from, so the
+    # query length is counted on the cut text itself, which is what the pair encoding tokenizes.
+    query_len_to_example_indices = collections.defaultdict(list)
+    for example_index, input_ids in enumerate(tokenizer(questions, add_special_tokens=False)["input_ids"]):
+        query_len_to_example_indices[len(input_ids)].append(example_index)
+
+    # The stride of the fast tokenizer is the overlap between spans, which depends on the query length.
+    # Examples are batched per query length so that consecutive spans always start doc_stride tokens apart, and
+    # every batch is cut to a fixed number of examples so that only one batch of encodings is held at a time.
+    batches = [
+        (query_len, example_indices[batch_start: batch_start + _FAST_TOKENIZER_BATCH_SIZE])
+        for query_len, example_indices in query_len_to_example_indices.items()
+        for batch_start in range(0, len(example_indices), _FAST_TOKENIZER_BATCH_SIZE)
+    ]
+    features = [[] for _ in examples]
+    with tqdm(total=len(examples), desc="convert squad examples to features", disable=not tqdm_enabled) as pbar:
+        for query_len, example_indices in batches:
+            encoded = tokenizer(
+                [questions[i] for i in example_indices],
+                [examples[i].context_text for i in example_indices],
+                truncation="only_second",
+                padding="max_length",
+                max_length=max_seq_length,
+                stride=max_seq_length - doc_stride - query_len - constants.sequence_pair_added_tokens,
+                return_overflowing_tokens=True,
+                return_offsets_mapping=True,
+                return_token_type_ids=True,
+                return_attention_mask=True,
+            )
+            batch_input_ids = np.asarray(encoded["input_ids"], dtype=np.int32)
+            batch_attention_mask = np.asarray(encoded["attention_mask"], dtype=np.uint8)
+            batch_token_type_ids = np.asarray(encoded["token_type_ids"], dtype=np.uint8)
+            example_index_to_span_indices = collections.defaultdict(list)
+            for span_index, sample_index in enumerate(encoded["overflow_to_sample_mapping"]):
+                example_index_to_span_indices[example_indices[sample_index]].append(span_index)
+
+            doc_offset = query_len + constants.sequence_added_tokens
+            for example_index, span_indices in example_index_to_span_indices.items():
+                example = examples[example_index]
+                tok_start_position = tok_end_position = None
+                if is_training and not example.is_impossible:
+                    tok_start_position = tok_end_position = -1
+
+                spans = []
+                for span_index in span_indices:
+                    context_index = _first_context_index(encoded, span_index)
+                    if context_index is not None and context_index != doc_offset:
+                        raise ValueError(
+                            "The context of example {} starts at token {} instead of {}, the query was not encoded "
+                            "into {} tokens.".format(example.qas_id, context_index, doc_offset, query_len)
+                        )
+                    input_ids = batch_input_ids[span_index]
+                    num_tokens = int(batch_attention_mask[span_index].sum())
+                    paragraph_len = num_tokens - query_len - constants.sequence_pair_added_tokens
+                    span_start = len(spans) * doc_stride
+
+                    if tok_start_position is not None and paragraph_len > 0:
+                        # map the answer character positions to paragraph token positions, (paragraph_len, 2)
+                        om = np.asarray(
+                            encoded["offset_mapping"][span_index][doc_offset: doc_offset + paragraph_len], dtype=np.int32
+                        )
+                        # Characters the tokenizer drops, like whitespace around the answer, belong to no token, so
+                        # the answer start maps to the first token ending after it, in the first span reaching it,
+                        # and the answer end to the last token starting at or before it, in the last span doing so.
+                        if tok_start_position == -1 and example.start_position < om[-1, 1]:
+                            tok_start_position = span_start + int(
+                                np.searchsorted(om[:, 1], example.start_position, side="right")
+                            )
+                        if om[0, 0] <= example.end_position:
+                            tok_end_position = span_start + int(
+                                np.searchsorted(om[:, 0], example.end_position, side="right")
+                            ) - 1
+
+                    spans.append({
+                        "input_ids": input_ids,
+                        "attention_mask": batch_attention_mask[span_index],
+                        "token_type_ids": batch_token_type_ids[span_index],
+                        "paragraph_len": paragraph_len,
+                        "tokens": (
+                            tokenizer.convert_ids_to_tokens(input_ids[:num_tokens].tolist()) if include_tokens else None
+                        ),
+                        "token_to_orig_map": (
+                            doc_offset, np.arange(span_start, span_start + paragraph_len, dtype=np.int32)
+                        ),
+                        "truncated_query_with_special_tokens_length": doc_offset,
+                        "start": span_start,
+                        "length": paragraph_len,
+                    })
+
+                if tok_start_position is not None and not 0 <= tok_start_position <= tok_end_position:
+                    # the answer covers no whole token, every span falls back to the CLS token
+                    tok_start_position = tok_end_position = -1
+                features[example_index] = spans_to_features(
+                    example, spans, tok_start_position, tok_end_position, is_training
+                )
+            pbar.update(len(example_indices))
+    fields = _stack_feature_fields(
+        [feature for example_features in features for feature in example_features], max_seq_length
+    )
+    return features, fields
+
+
+def _convert_examples_to_features_pool(
+        examples,
+        tokenizer,
+        max_seq_length,
+        doc_stride,
+        max_query_length,
+        is_training,
+        include_tokens,
+        threads,
+        tqdm_enabled=True,
+):
+    """Runs :func:`convert_example_to_features` in worker processes, for tokenizers without a Rust backend."""
+    threads = min(threads, cpu_count())
+    # Spans start every doc_stride tokens and a wordpiece token covers at least one non-whitespace character, which
+    # bounds the number of features of each example. Each example gets that many rows of the shared memory.
+    reserved_rows = np.fromiter(
+        (max(1, -(-sum(map(len, example.context_text.split())) // doc_stride)) for example in examples),
+        dtype=np.int64,
+        count=len(examples),
+    )
+    row_nbytes = max_seq_length * sum(np.dtype(dtype).itemsize for _, dtype in _FEATURE_ARRAY_FIELDS)
+    size = int(reserved_rows.sum()) * row_nbytes
+
+    # The segment is only backed by memory once it is written, the workers would be killed by SIGBUS on a full
+    # /dev/shm and the Pool would wait for their results forever. Without room, all the features are pickled.
+    free = shutil.disk_usage("/dev/shm").free if os.path.isdir("/dev/shm") else size
+    if free < size:
+        logger.warning(
+            "Only %d MB of the %d MB of shared memory needed are free in /dev/shm, the features are pickled instead.",
+            free // 2 ** 20, -(-size // 2 ** 20),
+        )
+        reserved_rows[:] = 0
+    first_rows = np.cumsum(reserved_rows) - reserved_rows
+    num_rows = int(reserved_rows.sum())
+    shared_memory = SharedMemory(create=True, size=max(1, num_rows * row_nbytes))
+    try:
+        # The tokenizer is shipped once per worker through the initializer. Examples are tagged with their index
+        # so they can be collected in completion order and sorted back afterwards.
+        with get_context("forkserver").Pool(
+                threads,
+                initializer=_convert_example_to_features_pool_init,
+                initargs=(tokenizer, shared_memory.name, num_rows, max_seq_length),
+        ) as p:
+            annotate_ = partial(
+                _convert_indexed_example_to_features,
+                max_seq_length=max_seq_length,
+                doc_stride=doc_stride,
+                max_query_length=max_query_length,
+                is_training=is_training,
+                include_tokens=include_tokens,
+            )
+            results = list(
+                tqdm(
+                    p.imap_unordered(
+                        annotate_,
+                        zip(range(len(examples)), zip(first_rows.tolist(), reserved_rows.tolist()), examples),
+                        chunksize=max(1, len(examples) // (threads * 8)),
+                    ),
+                    total=len(examples),
+                    desc="convert squad examples to features",
+                    disable=not tqdm_enabled,
+                )
+            )
+        results.sort(key=lambda x: x[0])
+
+        # The features written to the shared memory take their fields from their rows, the others from their pickles
+        features = [feature for _, example_features in results for feature in example_features]
+        fields = _stack_feature_fields(features, max_seq_length)
+        rows = []
+        positions = []
+        position = 0
+        for example_index, example_features in results:
+            first_row = int(first_rows[example_index])
+            num_shared_features = min(len(example_features), int(reserved_rows[example_index]))
+            rows.extend(range(first_row, first_row + num_shared_features))
+            positions.extend(range(position, position + num_shared_features))
+            position += len(example_features)
+        _copy_shared_feature_rows(shared_memory, num_rows, max_seq_length, rows, fields, positions)
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+
+    return [example_features for _, example_features in results], fields
 
 
 def convert_examples_to_features(
@@ -243,6 +633,8 @@ def convert_examples_to_features(
         return_dataset=False,
         threads=1,
         tqdm_enabled=True,
+        memmap_dir=None,
+        include_tokens=None,
 ):
     """
     Converts a list of examples into a list of features that can be directly given as input to a model.
@@ -250,7 +642,8 @@ def convert_examples_to_features(
 
     Args:
         examples: list of :class:`~transformers.data.processors.squad.SquadExample`
-        tokenizer: an instance of a child of :class:`~transformers.PreTrainedTokenizer`
+        tokenizer: an instance of a child of :class:`~transformers.PreTrainedTokenizer`. Fast tokenizers
+            (:class:`~transformers.PreTrainedTokenizerFast`) encode all the examples in batch in the main process.
         max_seq_length: The maximum sequence length of the inputs.
         doc_stride: The stride used when the context is too large and is split across several features.
         max_query_length: The maximum length of the query.
@@ -258,8 +651,13 @@ def convert_examples_to_features(
         return_dataset: Default False. Either 'pt' or 'tf'.
             if 'pt': returns a torch.data.TensorDataset,
             if 'tf': returns a tf.data.Dataset
-        threads: multiple processing threadsa-smi
+        threads: multiple processing threadsa-smi, only used with slow tokenizers
         tqdm_enabled:
+        memmap_dir: Default None. If set, the arrays of the PyTorch dataset are memory-mapped files in this directory,
+            and the features no longer keep their own input_ids, attention_mask, token_type_ids and p_mask.
+        include_tokens: Whether to store the tokens of every feature, defaults to `not is_training`. Only the
+            predictions need them, and they can be rebuilt from the input ids when they are missing. Always True
+            with memmap_dir, since the features then drop their input ids.
 
     Returns:
         list of :class:`~transformers.data.processors.squad.SquadFeatures`
@@ -281,57 +679,76 @@ def convert_examples_to_features(
 
     # Defining helper methods
     features = []
-    threads = min(threads, cpu_count())
-    with Pool(threads, initializer=convert_example_to_features_init, initargs=(tokenizer,)) as p:
-        annotate_ = partial(
-            convert_example_to_features,
-            max_seq_length=max_seq_length,
-            doc_stride=doc_stride,
-            max_query_length=max_query_length,
-            is_training=is_training,
+    if include_tokens is None:
+        include_tokens = not is_training or memmap_dir is not None
+    elif not include_tokens and memmap_dir is not None:
+        raise ValueError("include_tokens=False is not supported with memmap_dir, which drops the features' input ids.")
+    if isinstance(tokenizer, PreTrainedTokenizerFast):
+        # Batched calls into the Rust tokenizer replace the per-example worker processes, the tokenizer
+        # parallelizes each batch across its own thread pool.
+        features, fields = _convert_examples_to_features_fast(
+            examples, tokenizer, max_seq_length, doc_stride, max_query_length, is_training, include_tokens,
+            tqdm_enabled,
         )
-        features = list(
-            tqdm(
-                p.imap(annotate_, examples, chunksize=32),
-                total=len(examples),
-                desc="convert squad examples to features",
-                disable=not tqdm_enabled,
-            )
+    else:
+        features, fields = _convert_examples_to_features_pool(
+            examples, tokenizer, max_seq_length, doc_stride, max_query_length, is_training, include_tokens,
+            threads, tqdm_enabled,
         )
-    new_features = []
-    unique_id = 1000000000
-    example_index = 0
-    for example_features in tqdm(
-        features, total=len(features), desc="add example index and unique id", disable=not tqdm_enabled
+    # example_index only counts the examples that produced features, unique_id counts the features
+    span_counts = np.fromiter(
+        (len(example_features) for example_features in features), dtype=np.int64, count=len(features)
+    )
+    example_indices = np.repeat(np.arange(np.count_nonzero(span_counts)), span_counts[span_counts > 0])
+    features = [example_feature for example_features in features for example_feature in example_features]
+    for unique_id, (example_index, example_feature) in enumerate(
+            zip(example_indices.tolist(), features), start=1000000000
     ):
-        if not example_features:
-            continue
-        for example_feature in example_features:
-            example_feature.example_index = example_index
-            example_feature.unique_id = unique_id
-            new_features.append(example_feature)
-            unique_id += 1
-        example_index += 1
-    features = new_features
-    del new_features
+        example_feature.example_index = example_index
+        example_feature.unique_id = unique_id
     if return_dataset == "pt":
         if not is_torch_available():
             raise RuntimeError("PyTorch must be installed to return a PyTorch dataset.")
 
         # Convert to Tensors and build dataset
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long) # (total_num, max_seq_len)
-        all_attention_masks = torch.tensor([f.attention_mask for f in features], dtype=torch.long)  # (total_num, max_seq_len)
-        all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)   # (total_num, max_seq_len)
-        all_cls_index = torch.tensor([f.cls_index for f in features], dtype=torch.long) # (total_num, )
-        all_p_mask = torch.tensor([f.p_mask for f in features], dtype=torch.float)   # (total_num, max_seq_len)
-        all_is_impossible = torch.tensor([f.is_impossible for f in features], dtype=torch.float)    # (total_ num)
+        # Widen the stacked feature fields into preallocated arrays and share their memory with torch instead of
+        # letting torch.tensor parse nested python lists.
+        num_features = len(features)
+        input_ids = _new_feature_array((num_features, max_seq_length), np.int64, memmap_dir)
+        attention_masks = _new_feature_array((num_features, max_seq_length), np.int64, memmap_dir)
+        token_type_ids = _new_feature_array((num_features, max_seq_length), np.int64, memmap_dir)
+        p_mask = _new_feature_array((num_features, max_seq_length), np.float32, memmap_dir)
+        input_ids[:] = fields["input_ids"]
+        attention_masks[:] = fields["attention_mask"]
+        token_type_ids[:] = fields["token_type_ids"]
+        p_mask[:] = fields["p_mask"]
+        if memmap_dir is not None:
+            # the dataset now holds the only copy, let the page cache keep it instead of the stacked fields
+            for f in features:
+                f.input_ids = f.attention_mask = f.token_type_ids = f.p_mask = None
+            del fields
+
+        all_input_ids = torch.from_numpy(input_ids)  # (total_num, max_seq_len)
+        all_attention_masks = torch.from_numpy(attention_masks)  # (total_num, max_seq_len)
+        all_token_type_ids = torch.from_numpy(token_type_ids)   # (total_num, max_seq_len)
+        all_cls_index = torch.from_numpy(
+            np.fromiter((f.cls_index for f in features), dtype=np.int64, count=num_features)
+        )  # (total_num, )
+        all_p_mask = torch.from_numpy(p_mask)   # (total_num, max_seq_len)
+        all_is_impossible = torch.from_numpy(
+            np.fromiter((f.is_impossible for f in features), dtype=np.float32, count=num_features)
+        )    # (total_ num)
 
         if not is_training:
             all_feature_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
             dataset = TensorDataset(all_input_ids, all_attention_masks, all_token_type_ids, all_feature_index,all_cls_index, all_p_mask)
         else:
-            all_start_positions = torch.tensor([f.start_position for f in features], dtype=torch.long)  # (total_num)
-            all_end_positions = torch.tensor([f.end_position for f in features], dtype=torch.long)  # (total_num)
+            all_start_positions = torch.from_numpy(
+                np.fromiter((f.start_position for f in features), dtype=np.int64, count=num_features)
+            )  # (total_num)
+            all_end_positions = torch.from_numpy(
+                np.fromiter((f.end_position for f in features), dtype=np.int64, count=num_features)
+            )  # (total_num)
             dataset = TensorDataset(
                 all_input_ids,
                 all_attention_masks,
@@ -426,10 +843,7 @@ class AlibabaProcessor:
         # if self.train_file is None:
         #     raise ValueError("SquadProcessor should be instantiated via SquadV1Processor or SquadV2Processor")
 
-        with open(
-                os.path.join(data_dir, filename), "r", encoding="utf-8"
-        ) as reader:
-            input_data = json.load(reader)["data"]
+        input_data = self._read_input_data(os.path.join(data_dir, filename))
         return self._create_examples(input_data, 'train')
 
     def get_dev_examples(self, data_dir, filename):
@@ -447,12 +861,16 @@ class AlibabaProcessor:
         # if self.dev_file is None:
         #     raise ValueError("SquadProcessor should be instantiated via SquadV1Processor or SquadV2Processor")
 
-        with open(
-                os.path.join(data_dir, filename), "r", encoding="utf-8"
-        ) as reader:
-            input_data = json.load(reader)["data"]
+        input_data = self._read_input_data(os.path.join(data_dir, filename))
         return self._create_examples(input_data, 'dev')
 
+    def _read_input_data(self, path):
+        """Reads the "data" entries of a SQuAD-style json file, with orjson when it is installed."""
+        with open(path, "rb") as reader:
+            if orjson is not None:
+                return orjson.loads(reader.read())["data"]
+            return json.load(reader)["data"]
+
     def _create_examples(self, input_data, set_type):
         is_training = set_type == "train"
         examples = []
@@ -541,6 +959,19 @@ class AlibabaExample:
         is_impossible: False by default, set to True if the example has no possible answer.
     """
 
+    __slots__ = (
+        "qas_id",
+        "question_text",
+        "context_text",
+        "answer_text",
+        "title",
+        "is_impossible",
+        "is_challenge",
+        "answers",
+        "start_position",
+        "end_position",
+    )
+
     def __init__(
             self,
             qas_id,
@@ -576,24 +1007,43 @@ class AlibabaFeatures(object):
     using the :method:`~transformers.data.processors.squad.squad_convert_examples_to_features` method.
 
     Args:
-        input_ids: Indices of input sequence tokens in the vocabulary.
-        attention_mask: Mask to avoid performing attention on padding token indices.
-        token_type_ids: Segment token indices to indicate first and second portions of the inputs.
+        input_ids: int32 array of the indices of input sequence tokens in the vocabulary.
+        attention_mask: uint8 mask to avoid performing attention on padding token indices.
+        token_type_ids: uint8 segment token indices to indicate first and second portions of the inputs.
         cls_index: the index of the CLS token.
-        p_mask: Mask identifying tokens that can be answers vs. tokens that cannot.
+        p_mask: uint8 mask identifying tokens that can be answers vs. tokens that cannot.
             Mask with 1 for tokens than cannot be in the answer and 0 for token that can be in an answer
         example_index: the index of the example
         unique_id: The unique Feature identifier
         paragraph_len: The length of the context
-        token_is_max_context: List of booleans identifying which tokens have their maximum context in this feature object.
+        token_is_max_context: uint8 array identifying which tokens have their maximum context in this feature object.
             If a token does not have their maximum context in this feature object, it means that another feature object
             has more information related to that token and should be prioritized over this feature for that token.
         tokens: list of tokens corresponding to the input ids
         token_to_orig_map: mapping between the tokens and the original text, needed in order to identify the answer.
+            A tuple (doc_offset, orig_indices): the token at index i >= doc_offset maps to orig_indices[i - doc_offset].
         start_position: start of the answer token index
         end_position: end of the answer token index
     """
 
+    __slots__ = (
+        "input_ids",
+        "attention_mask",
+        "token_type_ids",
+        "cls_index",
+        "p_mask",
+        "example_index",
+        "unique_id",
+        "paragraph_len",
+        "token_is_max_context",
+        "tokens",
+        "token_to_orig_map",
+        "start_position",
+        "end_position",
+        "is_impossible",
+        "qas_id",
+    )
+
     def __init__(
             self,
             input_ids,
@@ -641,6 +1091,8 @@ class AlibabaResult(object):
         end_logits: The logits corresponding to the end of the answer
     """
 
+    __slots__ = ("start_logits", "end_logits", "unique_id", "start_top_index", "end_top_index", "cls_logits")
+
     def __init__(self, unique_id, start_logits, end_logits, start_top_index=None, end_top_index=None, cls_logits=None):
         self.start_logits = start_logits
         self.end_logits = end_logits
@@ -389,6 +389,15 @@ def _compute_softmax(scores):
     return probs
 
 
+def _rebuild_feature_tokens(feature, tokenizer):
+    """Returns the tokens of the feature, rebuilt from its input ids if it was built with include_tokens=False."""
+    if feature.tokens is None:
+        # only the tokens up to the end of the paragraph can be part of an answer
+        doc_offset, orig_indices = feature.token_to_orig_map
+        feature.tokens = tokenizer.convert_ids_to_tokens(feature.input_ids[: doc_offset + len(orig_indices)])
+    return feature.tokens
+
+
 def compute_predictions_logits(
         all_examples,
         all_features,
@@ -441,6 +450,8 @@ def compute_predictions_logits(
 
         for (feature_index, feature) in enumerate(features):
             result = unique_id_to_result[feature.unique_id]
+            doc_offset, orig_indices = feature.token_to_orig_map
+            _rebuild_feature_tokens(feature, tokenizer)
             start_indexes = _get_best_indexes(result.start_logits, n_best_size)
             end_indexes = _get_best_indexes(result.end_logits, n_best_size)
 
@@ -461,11 +472,11 @@ def compute_predictions_logits(
                         continue
                     if end_index >= len(feature.tokens):
                         continue
-                    if start_index not in feature.token_to_orig_map:
+                    if not doc_offset <= start_index < doc_offset + len(orig_indices):
                         continue
-                    if end_index not in feature.token_to_orig_map:
+                    if not doc_offset <= end_index < doc_offset + len(orig_indices):
                         continue
-                    if not feature.token_is_max_context.get(start_index, False):
+                    if not feature.token_is_max_context[start_index]:
                         continue
                     if end_index < start_index:
                         continue
@@ -664,7 +675,7 @@ def compute_predictions_log_probs(
                     if end_index >= feature.paragraph_len - 1:
                         continue
 
-                    if not feature.token_is_max_context.get(start_index, False):
+                    if not feature.token_is_max_context[start_index]:
                         continue
                     if end_index < start_index:
                         continue
@@ -704,9 +715,10 @@ def compute_predictions_log_probs(
             # final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
 
             # Previously used Bert untokenizer
-            tok_tokens = feature.tokens[pred.start_index: (pred.end_index + 1)]
-            orig_doc_start = feature.token_to_orig_map[pred.start_index]
-            orig_doc_end = feature.token_to_orig_map[pred.end_index]
+            tok_tokens = _rebuild_feature_tokens(feature, tokenizer)[pred.start_index: (pred.end_index + 1)]
+            doc_offset, orig_indices = feature.token_to_orig_map
+            orig_doc_start = int(orig_indices[pred.start_index - doc_offset])
+            orig_doc_end = int(orig_indices[pred.end_index - doc_offset])
             orig_tokens = example.doc_tokens[orig_doc_start: (orig_doc_end + 1)]
             tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
 
@@ -45,7 +45,7 @@ from transformers import (
 #     squad_evaluate,
 # )
 from baseline.metrics import compute_predictions_logits, alibaba_evaluate
-from baseline.dataset import AlibabaProcessor, convert_examples_to_features, AlibabaResult
+from baseline.dataset import AlibabaProcessor, convert_examples_to_features, AlibabaResult, FEATURES_FORMAT_VERSION
 
 try:
     from torch.utils.tensorboard import SummaryWriter
@@ -373,10 +373,12 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
     input_dir = args.data_dir if args.data_dir else "."
     cached_features_file = os.path.join(
         input_dir,
-        "cached_{}_{}_{}".format(
+        "cached_{}_{}_{}{}_v{}".format(
             args.predict_file.split('.')[0] if evaluate else args.train_file.split('.')[0],
             list(filter(None, args.model_name_or_path.split("/"))).pop(),
             str(args.max_seq_length),
+            "_fast" if args.use_fast_tokenizer else "",
+            FEATURES_FORMAT_VERSION,
         ),
     )
 
@@ -410,6 +412,7 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
             is_training=not evaluate,
             return_dataset="pt",
             threads=args.threads,
+            memmap_dir=args.memmap_dir,
         )
 
         if args.local_rank in [-1, 0]:
@@ -617,6 +620,18 @@ def main():
     parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
 
     parser.add_argument("--threads", type=int, default=1, help="multiple threads for converting example to features")
+    parser.add_argument(
+        "--memmap_dir",
+        default=None,
+        type=str,
+        help="If set, back the feature tensors with memory-mapped files in this directory while building them",
+    )
+    parser.add_argument(
+        "--use_fast_tokenizer",
+        action="store_true",
+        help="Convert the examples in batch with the fast tokenizer. Its p_mask also masks [UNK] tokens and its "
+        "training labels follow the annotated answer offset rather than the first occurrence of the answer text",
+    )
     args = parser.parse_args()
 
     if args.doc_stride >= args.max_seq_length - args.max_query_length:
@@ -692,6 +707,7 @@ def main():
     tokenizer = AutoTokenizer.from_pretrained(
         args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
         cache_dir=args.cache_dir if args.cache_dir else None,
+        use_fast=args.use_fast_tokenizer,
     )
     model = AutoModelForQuestionAnswering.from_pretrained(
         args.model_name_or_path,
@@ -744,7 +760,7 @@ def main():
 
         # Load a trained model and vocabulary that you have fine-tuned
         model = AutoModelForQuestionAnswering.from_pretrained(args.output_dir)  # , force_download=True)
-        tokenizer = AutoTokenizer.from_pretrained(args.output_dir)
+        tokenizer = AutoTokenizer.from_pretrained(args.output_dir, use_fast=args.use_fast_tokenizer)
         model.to(args.device)
 
     # Evaluation - we can ask to evaluate all the checkpoints (sub-directories) in a directory